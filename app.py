@@ -3,8 +3,11 @@ import plotly.graph_objects as go
 import pandas as pd
 import yfinance as yf
 import numpy as np
+import re
+import time
 # 移除了 components 的 import，因為 TradingView 移除了
 from datetime import datetime, timedelta
+from pathlib import Path
 
 # --- 1. 基礎設定 ---
 st.set_page_config(page_title="結構型商品戰情室 (V10.7 - No Profile)", layout="wide")
@@ -71,95 +74,203 @@ run_btn = st.sidebar.button("🚀 開始分析", type="primary")
 
 # (已移除 TradingView 函數)
 
-def get_stock_data_from_2009(ticker):
+PLOT_DAYS = 750  # 主圖顯示近 3 年
+TICKER_SPLIT = re.compile(r'[,\s]+')  # 代碼可用逗號、空白或換行分隔
+CACHE_TTL = 3600  # 股價快取有效秒數 (記憶體與磁碟共用)
+FAILED_RETRY_SECONDS = 60  # 下載失敗的標的隔多久才重新請求
+PRICE_CACHE_DIR = Path(__file__).parent / "cache"  # 收盤價 parquet 快取，程式重啟後仍可用
+
+def price_cache_path(ticker):
+    return PRICE_CACHE_DIR / (re.sub(r'[^A-Z0-9.^=_-]', '_', ticker) + ".parquet")
+
+def read_price_cache(ticker):
+    """讀取 CACHE_TTL 內寫入的收盤價快取，沒有或已過期回傳 None"""
+    path = price_cache_path(ticker)
+    try:
+        if time.time() - path.stat().st_mtime > CACHE_TTL: return None
+        return pd.read_parquet(path)
+    except Exception:
+        return None  # 沒有檔案或讀取失敗就當作沒有快取
+
+def write_price_cache(ticker, close_df):
     try:
-        start_date = "2009-01-01"
-        df = yf.download(ticker, start=start_date, progress=False)
-        
-        if df.empty: return None, f"找不到 {ticker} 或該期間無資料"
-        
-        df = df.reset_index()
-        if isinstance(df.columns, pd.MultiIndex):
-            df.columns = df.columns.get_level_values(0)
-        df = df.loc[:, ~df.columns.duplicated()]
-        
-        if 'Close' not in df.columns: return None, "無收盤價資料"
-
-        df['Date'] = pd.to_datetime(df['Date'])
-        df['Close'] = pd.to_numeric(df['Close'], errors='coerce')
-        df = df.dropna(subset=['Close'])
-
-        # 均線
-        df['MA20'] = df['Close'].rolling(window=20).mean()
-        df['MA60'] = df['Close'].rolling(window=60).mean()
-        df['MA240'] = df['Close'].rolling(window=240).mean()
-        
-        return df, None
+        PRICE_CACHE_DIR.mkdir(exist_ok=True)
+        close_df.to_parquet(price_cache_path(ticker), compression='zstd')
+    except Exception:
+        pass  # 快取寫不進去不影響分析
+
+class IncompleteDownload(Exception):
+    """有標的沒下載到收盤價 (yfinance 失敗時不會 raise，只回傳空欄位)；帶著這次的資料，但不讓 st.cache_data 快取"""
+    def __init__(self, raw, failed):
+        super().__init__(f"下載失敗: {', '.join(failed)}")
+        self.raw = raw
+
+def has_close(raw, ticker):
+    return (ticker, 'Close') in raw.columns and raw[(ticker, 'Close')].notna().any()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def download_price_history(tickers, start_date, end_date):
+    """一次批次下載所有標的 (快取 1 小時，調整參數重跑時不必重新連線)；有任一標的失敗則 raise，這批不進快取"""
+    raw = yf.download(list(tickers), start=start_date, end=end_date, group_by='ticker', threads=True, progress=False)
+    if not isinstance(raw.columns, pd.MultiIndex):
+        raw = pd.concat({tickers[0]: raw}, axis=1, names=['Ticker', 'Price'])  # 舊版 yfinance 單一標的回傳單層欄位，補成 (Ticker, 欄位)
+    failed = [t for t in tickers if not has_close(raw, t)]
+    if failed: raise IncompleteDownload(raw, failed)
+    return raw
+
+@st.cache_resource(show_spinner=False)
+def recent_download_failures():
+    """{ticker: 最近一次下載失敗的時間}，所有 session 共用"""
+    return {}
+
+def download_all_from_2009(tickers, end_date):
+    """回傳 (Ticker, 欄位) 兩層欄位的收盤價表：先讀磁碟快取，只下載沒有快取或已過期的標的
+    下載失敗的標的 (代碼打錯、被限流) FAILED_RETRY_SECONDS 內不再請求，之後單獨一批重試，不拖著成功的標的一起重抓"""
+    try:
+        frames = {t: read_price_cache(t) for t in tickers}
+        failures = recent_download_failures()
+        now = time.time()
+        missing = [t for t, f in frames.items() if f is None and now - failures.get(t, 0) > FAILED_RETRY_SECONDS]
+        fresh = tuple(t for t in missing if t not in failures)
+        retry = tuple(t for t in missing if t in failures)
+        for group in (fresh, retry):
+            if not group: continue
+            try:
+                raw = download_price_history(group, "2009-01-01", end_date)
+            except IncompleteDownload as e:
+                raw = e.raw  # 成功的標的照用並寫入磁碟快取；失敗的只記下時間，由 get_stock_data_from_2009 回報
+            for t in group:
+                if not has_close(raw, t):
+                    failures[t] = now
+                    continue
+                failures.pop(t, None)
+                close_df = raw[t][['Close']].dropna()  # 保留 float64：float32 在約 13 萬元以上就存不到分位 (如 BRK-A)
+                frames[t] = close_df
+                write_price_cache(t, close_df)
+        frames = {t: f for t, f in frames.items() if f is not None}
+        if not frames: return pd.DataFrame(columns=pd.MultiIndex.from_tuples([], names=['Ticker', 'Price'])), None
+        return pd.concat(frames, axis=1, names=['Ticker', 'Price']), None
     except Exception as e:
         return None, str(e)
 
-def run_comprehensive_backtest(df, ki_pct, strike_pct, months):
-    """綜合回測邏輯"""
+def moving_average(cs, window, n):
+    """由累加和 cs (首項補 0) 計算簡單均線，前 window-1 筆為 NaN"""
+    out = np.full(n, np.nan, dtype=np.float32)
+    out[window-1:] = (cs[window:] - cs[:-window]) / window
+    return out
+
+def get_stock_data_from_2009(ticker, raw):
+    """清理單一標的 (不快取：每次都用 download_all_from_2009 剛取得的 raw，只需不到 1 ms)；失敗時 raise ValueError"""
+    # raw 一律是 download_all_from_2009 組出的 (Ticker, 'Close') 兩層欄位表
+    if ticker not in raw.columns.get_level_values(0): raise ValueError(f"找不到 {ticker} 或該期間無資料")
+    df = raw[ticker]
+
+    # 直接從陣列組出最終表格 (只保留收盤價，其餘 OHLCV 欄位不複製)
+    # 批次下載時日期取聯集，其他標的的交易日在此標的是 NaN，一併濾掉
+    # yfinance / parquet 快取給的已是浮點數與 DatetimeIndex，只有其他型別才需要再轉換
+    close = df['Close'].to_numpy()
+    if close.dtype.kind != 'f': close = np.asarray(pd.to_numeric(close, errors='coerce'), dtype=np.float64)
+    valid = ~np.isnan(close)
+    if not valid.any(): raise ValueError(f"找不到 {ticker} 或該期間無資料")
+    close = close[valid]
+    dates = df.index.to_numpy()[valid]
+    if dates.dtype.kind != 'M': dates = pd.to_datetime(dates, cache=True)
+
+    # 顯示用的價格保留 float64 (float32 約 13 萬元以上就存不到分位)；回測才轉 float32，只比較相對幅度，精度足夠
+    df = pd.DataFrame({
+        'Date': dates,
+        'Close': close.astype(np.float64, copy=False),
+    })
+    return df
+
+def forward_window_min(x, window):
+    """x[i:i+window] 的最小值 (i = 0 .. n-window)，van Herk/Gil-Werman 分塊演算法，O(N) 與視窗長度無關"""
+    n = len(x)
+    if n < window: return x[:0]
+    blocks = -(-n // window)
+    padded = np.full(blocks * window, np.inf, dtype=x.dtype)
+    padded[:n] = x
+    padded = padded.reshape(blocks, window)
+    prefix = np.minimum.accumulate(padded, axis=1).ravel()  # 塊內由左往右累積最小
+    suffix = np.minimum.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()  # 塊內由右往左累積最小
+    return np.minimum(suffix[:n - window + 1], prefix[window - 1:n])
+
+def first_at_least(x, starts, targets):
+    """每個查詢 i 回傳 starts[i] 起第一個 x >= targets[i] 的位置 (找不到為 len(x))；區間最大值稀疏表 + 倍增，全部查詢一起向量化，O((N + M) log N)"""
+    n = len(x)
+    levels = [x]  # levels[k][p] = max(x[p:p + 2**k])
+    while 2 ** len(levels) <= n:
+        step = 2 ** (len(levels) - 1)
+        levels.append(np.maximum(levels[-1][:-step], levels[-1][step:]))
+    pos = np.asarray(starts, dtype=np.int64).copy()
+    for k in range(len(levels) - 1, -1, -1):
+        lv = levels[k]
+        # 若 [pos, pos + 2**k) 全部都 < target，整段跳過
+        skip = (pos < len(lv)) & (lv[np.minimum(pos, len(lv) - 1)] < targets)
+        pos += skip * 2 ** k
+    return pos
+
+def forward_window_max(x, window):
+    """x[i:i+window] 的最大值 (i = 0 .. n-window)"""
+    return -forward_window_min(-x, window)
+
+# 每期結果代碼 (uint8)
+RESULT_SAFE, RESULT_KI_RECOVERED, RESULT_LOSS, RESULT_KO = 0, 1, 2, 3  # 未觸及 KI / 觸及 KI 但期末站回 Strike / 接股票 / 期間內敲出
+
+def backtest_kernel(closes, trading_days, ki_frac, strike_frac, ko_frac):
+    """回測核心 (純 ndarray)：第 i 期以 closes[i] 進場、closes[i + trading_days] 到期，只算完整天期的各期"""
+    m = max(len(closes) - trading_days, 0)
+    start = closes[:m]
+    final = closes[trading_days:trading_days + m]
+    min_during = forward_window_min(closes, trading_days)[:m]
+    # 進場後第 1 ~ trading_days 天任一天收盤站上 KO 即提前出場拿回本金，不會接股票
+    ko_hit = forward_window_max(closes[1:], trading_days)[:m] >= start * ko_frac
+    strike_level = start * strike_frac
+    touched_ki = min_during < start * ki_frac
+    is_loss = touched_ki & (final < strike_level) & ~ko_hit
+    gap = (final - strike_level) / strike_level * 100  # 接股票顯示實際距離 Strike 的幅度，安全則最低為 0
+    redeemed = (1 / strike_frac - 1) * 100  # 敲出時以面額 (進場價) 提前贖回，距離 Strike 固定為此值，與原到期日股價無關
+    bar_value = np.where(is_loss, gap, np.where(ko_hit, redeemed, np.maximum(0, gap)))
+    return final, touched_ki, ko_hit, is_loss, bar_value
+
+@st.cache_data(show_spinner=False, max_entries=100)
+def run_comprehensive_backtest(dates, closes, ki_pct, strike_pct, months, ko_pct):
+    """綜合回測邏輯 (dates / closes 為 ndarray；依資料內容 + KI/Strike/天期/KO 快取，只改配息時不重算)"""
     trading_days = int(months * 21)
-    bt = df[['Date', 'Close']].copy()
-    bt.columns = ['Start_Date', 'Start_Price']
-    
-    bt['End_Date'] = bt['Start_Date'].shift(-trading_days)
-    bt['Final_Price'] = bt['Start_Price'].shift(-trading_days)
+    final, touched_ki, ko_hit, is_loss, bar_value = backtest_kernel(closes, trading_days, ki_pct / 100, strike_pct / 100, ko_pct / 100)
     
-    indexer = pd.api.indexers.FixedForwardWindowIndexer(window_size=trading_days)
-    bt['Min_Price_During'] = bt['Start_Price'].rolling(window=indexer, min_periods=1).min()
+    m = len(final)
+    if m == 0: return None, None
     
-    bt = bt.dropna()
+    result_code = np.select([ko_hit, is_loss, touched_ki], [RESULT_KO, RESULT_LOSS, RESULT_KI_RECOVERED], RESULT_SAFE).astype(np.uint8)
     
-    if bt.empty: return None, None
+    # 只為 bar 圖組一次 DataFrame，只放圖會用到的欄位 (快取裡每筆都要存)
+    bt = pd.DataFrame({
+        'Start_Date': dates[:m],
+        'Result_Code': result_code,
+        'Bar_Value': bar_value,
+    })
     
-    bt['KI_Level'] = bt['Start_Price'] * (ki_pct / 100)
-    bt['Strike_Level'] = bt['Start_Price'] * (strike_pct / 100)
-    
-    bt['Touched_KI'] = bt['Min_Price_During'] < bt['KI_Level']
-    bt['Below_Strike'] = bt['Final_Price'] < bt['Strike_Level']
-    
-    conditions = [
-        (bt['Touched_KI'] == True) & (bt['Below_Strike'] == True),
-        (bt['Touched_KI'] == True) & (bt['Below_Strike'] == False),
-        (bt['Touched_KI'] == False)
-    ]
-    choices = ['Loss', 'Safe', 'Safe']
-    bt['Result_Type'] = np.select(conditions, choices, default='Unknown')
-    
-    # 計算回本天數
-    loss_indices = bt[bt['Result_Type'] == 'Loss'].index
-    recovery_counts = [] 
-    stuck_count = 0
-    
-    for idx in loss_indices:
-        row = bt.loc[idx]
-        target_price = row['Strike_Level']
-        end_date = row['End_Date']
-        future_data = df[(df['Date'] > end_date) & (df['Close'] >= target_price)]
-        
-        if not future_data.empty:
-            days_needed = (future_data.iloc[0]['Date'] - end_date).days
-            recovery_counts.append(days_needed)
-        else:
-            stuck_count += 1
-
-    # Bar圖資料
-    def calculate_bar_value(row):
-        gap = ((row['Final_Price'] - row['Strike_Level']) / row['Strike_Level']) * 100
-        return gap if row['Result_Type'] == 'Loss' else max(0, gap)
-
-    bt['Bar_Value'] = bt.apply(calculate_bar_value, axis=1)
-    bt['Color'] = np.where(bt['Result_Type'] == 'Loss', 'red', 'green')
+    # 計算回本天數：期末之後第一個收盤 >= Strike 的交易日
+    loss_indices = np.flatnonzero(is_loss)
+    loss_targets = closes[loss_indices] * (strike_pct / 100)
+    search_from = loss_indices + trading_days + 1  # 第 i 期的期末即 df 第 i + trading_days 列
+    # 先用「之後的最高收盤」判斷能否解套 (每期 O(1))，只對會解套的期數找日期
+    future_max = np.append(np.maximum.accumulate(closes[::-1])[::-1], -np.inf)  # future_max[p] = max(closes[p:])
+    recovered = future_max[search_from] >= loss_targets
+    recovery_days = np.full(len(loss_indices), -1, dtype=np.int32)  # -1 = 至今尚未解套
+    hit = first_at_least(closes, search_from[recovered], loss_targets[recovered])
+    recovery_days[recovered] = (dates[hit] - dates[search_from[recovered] - 1]) // np.timedelta64(1, 'D')
+
+    stuck_count = int((~recovered).sum())
 
     # 統計
-    total = len(bt)
-    safe_count = len(bt[bt['Result_Type'] == 'Safe'])
+    total = m
+    safe_count = int((result_code != RESULT_LOSS).sum())
     safety_prob = (safe_count / total) * 100
-    pos_count = len(bt[bt['Final_Price'] > bt['Start_Price']])
+    pos_count = int((final > closes[:m]).sum())
     pos_prob = (pos_count / total) * 100
-    avg_recovery = np.mean(recovery_counts) if recovery_counts else 0
+    avg_recovery = recovery_days[recovered].mean() if recovered.any() else 0
     
     stats = {
         'safety_prob': safety_prob,
@@ -171,62 +282,95 @@ def run_comprehensive_backtest(df, ki_pct, strike_pct, months):
     
     return bt, stats
 
-def plot_integrated_chart(df, ticker, current_price, p_ko, p_ki, p_st):
-    """主圖：走勢 + 關鍵價位"""
-    plot_df = df.tail(750).copy() # 顯示近3年
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['Close'], mode='lines', name='股價', line=dict(color='black', width=1.5)))
-    fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MA20'], mode='lines', name='月線', line=dict(color='#3498db', width=1)))
-    fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MA60'], mode='lines', name='季線', line=dict(color='#f1c40f', width=1)))
-    fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MA240'], mode='lines', name='年線', line=dict(color='#9b59b6', width=1)))
-
-    # KO
-    fig.add_hline(y=p_ko, line_dash="dash", line_color="red", line_width=2)
-    fig.add_annotation(x=1, y=p_ko, xref="paper", yref="y", text=f"KO: {p_ko:.2f}", showarrow=False, xanchor="left", font=dict(color="red"))
-    # Strike
-    fig.add_hline(y=p_st, line_dash="solid", line_color="green", line_width=2)
-    fig.add_annotation(x=1, y=p_st, xref="paper", yref="y", text=f"Strike: {p_st:.2f}", showarrow=False, xanchor="left", font=dict(color="green"))
-    # KI
-    fig.add_hline(y=p_ki, line_dash="dot", line_color="orange", line_width=2)
-    fig.add_annotation(x=1, y=p_ki, xref="paper", yref="y", text=f"KI: {p_ki:.2f}", showarrow=False, xanchor="left", font=dict(color="orange"))
-
-    all_prices = [p_ko, p_ki, p_st, plot_df['Close'].max(), plot_df['Close'].min()]
-    y_min, y_max = min(all_prices)*0.9, max(all_prices)*1.05
-
-    fig.update_layout(title=f"{ticker} - 走勢與關鍵價位 (近3年)", height=450, margin=dict(r=80), xaxis_title="日期", yaxis_title="價格", yaxis_range=[y_min, y_max], hovermode="x unified", legend=dict(orientation="h", y=1.02, x=0))
-    return fig
+def level_line(y, color, dash, width):
+    """水平線 shape (等同 add_hline，但直接放進 layout，不逐次驗證)"""
+    return dict(type='line', xref='x domain', x0=0, x1=1, yref='y', y0=y, y1=y, line=dict(color=color, dash=dash, width=width))
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=100, show_spinner=False)
+def price_line_traces(ticker, data_hash, _df):
+    """主圖的股價 + 均線 traces：同一份資料 (ticker + 繪圖區段的雜湊) 只建一次，KO/KI/Strike 調整時直接重用"""
+    dates = np.datetime_as_string(_df['Date'].to_numpy()[-PLOT_DAYS:], unit='D')  # 'YYYY-MM-DD'，四條線共用同一份
+
+    # 均線 (共用一次累加和，每條均線只需一次相減)；多取 239 天暖身，年線在圖左緣也有值
+    close = _df['Close'].to_numpy()[-(PLOT_DAYS + 239):]
+    cs = np.empty(len(close) + 1)
+    cs[0] = 0.0
+    np.cumsum(close, dtype=np.float64, out=cs[1:])
+    series = {w: moving_average(cs, w, len(close))[-PLOT_DAYS:] for w in (20, 60, 240)}
+
+    lines = [(close[-PLOT_DAYS:], '股價', 'black', 1.5), (series[20], '月線', '#3498db', 1), (series[60], '季線', '#f1c40f', 1), (series[240], '年線', '#9b59b6', 1)]
+    return [dict(type='scattergl', x=dates, y=y, mode='lines', name=name, line=dict(color=color, width=width)) for y, name, color, width in lines]
+
+def plot_integrated_chart(df, ticker, price_lo, price_hi, p_ko, p_ki, p_st):
+    """主圖：走勢 + 關鍵價位 (price_lo / price_hi 為近 3 年收盤最低 / 最高)"""
+    # 只雜湊實際畫出的區段 (含均線暖身)，盤中收盤價或還原權值更新時會重建
+    data_hash = int(pd.util.hash_pandas_object(df.tail(PLOT_DAYS + 239), index=False).sum())
+    data = price_line_traces(ticker, data_hash, df)
+
+    # KO / Strike / KI
+    levels = [('KO', p_ko, 'red', 'dash'), ('Strike', p_st, 'green', 'solid'), ('KI', p_ki, 'orange', 'dot')]
+    shapes = [level_line(y, color, dash, 2) for _, y, color, dash in levels]
+    annotations = [dict(x=1, y=y, xref="paper", yref="y", text=f"{label}: {y:.2f}", showarrow=False, xanchor="left", font=dict(color=color)) for label, y, color, _ in levels]
+
+    y_min = min(price_lo, p_ko, p_ki, p_st) * 0.9
+    y_max = max(price_hi, p_ko, p_ki, p_st) * 1.05
+
+    layout = dict(title=dict(text=f"{ticker} - 走勢與關鍵價位 (近3年)"), height=450, margin=dict(r=80), xaxis=dict(title=dict(text="日期")), yaxis=dict(title=dict(text="價格"), range=[y_min, y_max]), hovermode="x unified", legend=dict(orientation="h", y=1.02, x=0), shapes=shapes, annotations=annotations)
+    return go.Figure(data=data, layout=layout)
+
+BAR_WEEKLY_ABOVE = 1000  # 回測期數超過此值時 bar 圖改為每週一根
+
+def weekly_bars(x, y, reduce):
+    """把依日期排序的 (x, y) 併成每週 (週一起算) 一根：x 取該週第一個進場日，y 以 reduce (np.add / np.minimum ...) 的 reduceat 彙總，另回傳每週筆數"""
+    week = (x + np.timedelta64(3, 'D')).astype('datetime64[W]')  # numpy 的週從週四起算，平移 3 天改成週一
+    starts = np.flatnonzero(np.r_[True, week[1:] != week[:-1]])
+    return x[starts], reduce.reduceat(y, starts), np.diff(np.r_[starts, len(x)])
 
 def plot_rolling_bar_chart(bt_data, ticker):
-    """Bar 圖：回測結果"""
-    fig = go.Figure()
-    fig.add_trace(go.Bar(x=bt_data['Start_Date'], y=bt_data['Bar_Value'], marker_color=bt_data['Color'], name='期末表現'))
-    fig.add_hline(y=0, line_width=1, line_color="black")
-    
-    fig.update_layout(title=f"{ticker} - 滾動回測損益分佈 (2009至今)", xaxis_title="進場日期", yaxis_title="期末距離 Strike (%)", height=350, margin=dict(l=20, r=20, t=40, b=20), showlegend=False, hovermode="x unified")
-    return fig
+    """Bar 圖：回測結果 (安全 / 接股票分成兩個單色 trace，不必逐筆傳顏色)"""
+    is_loss = (bt_data['Result_Code'] == RESULT_LOSS).to_numpy()
+    x, y = bt_data['Start_Date'].to_numpy(), bt_data['Bar_Value'].to_numpy()
+    data = []
+    # 併成每週時：綠色取週平均；紅色取該週最深的虧損，風險不會被平均掉 (綠色 >= 0、紅色 < 0，同週兩根上下分開不重疊)
+    for mask, color, name, weekly_mean in ((~is_loss, 'green', '安全', True), (is_loss, 'red', '接股票', False)):
+        bx, by = x[mask], y[mask]
+        if len(x) > BAR_WEEKLY_ABOVE and len(bx):
+            bx, agg, count = weekly_bars(bx, by, np.add if weekly_mean else np.minimum)
+            by = agg / count if weekly_mean else agg
+        data.append(dict(type='bar', x=bx, y=by, marker=dict(color=color), name=name))
+    # 上千根 bar：hover 只找游標最近的一根，不做整條 x 的 unified 掃描
+    layout = dict(title=dict(text=f"{ticker} - 滾動回測損益分佈 (2009至今)"), xaxis=dict(title=dict(text="進場日期")), yaxis=dict(title=dict(text="期末距離 Strike (%)")), height=350, margin=dict(l=20, r=20, t=40, b=20), showlegend=False, barmode='overlay', hovermode="closest", shapes=[level_line(0, "black", None, 1)])
+    return go.Figure(data=data, layout=layout)
 
 # --- 4. 執行邏輯 ---
 
 if run_btn:
-    ticker_list = [t.strip().upper() for t in tickers_input.split(',') if t.strip()]
+    ticker_list = [t.upper() for t in TICKER_SPLIT.split(tickers_input) if t]
     
     if not ticker_list:
         st.warning("請輸入代碼")
     else:
+        end_date = (datetime.now() + timedelta(days=1)).date()  # end 不含當日，+1 天才會包含今天
+        with st.spinner(f"正在下載 {', '.join(ticker_list)} (2009-Now) ..."):
+            raw, download_err = download_all_from_2009(tuple(ticker_list), end_date)
+
         for ticker in ticker_list:
             st.markdown(f"### 📌 標的：{ticker}")
 
             # (已移除 TradingView 區塊)
             
-            with st.spinner(f"正在分析 {ticker} (2009-Now) ..."):
-                df, err = get_stock_data_from_2009(ticker)
-            
-            if err:
-                st.error(f"{ticker} 讀取失敗: {err}")
+            try:
+                if download_err: raise ValueError(download_err)
+                df = get_stock_data_from_2009(ticker, raw)
+            except Exception as e:
+                st.error(f"{ticker} 讀取失敗: {e}")
                 continue
                 
             try:
-                current_price = float(df['Close'].iloc[-1])
+                close = df['Close'].to_numpy()
+                current_price = float(close[-1])
+                recent = close[-PLOT_DAYS:]
+                price_lo, price_hi = float(recent.min()), float(recent.max())
                 p_ko = current_price * (ko_pct / 100)
                 p_st = current_price * (strike_pct / 100)
                 p_ki = current_price * (ki_pct / 100)
@@ -234,7 +378,7 @@ if run_btn:
                 st.error(f"{ticker} 價格計算錯誤")
                 continue
 
-            bt_data, stats = run_comprehensive_backtest(df, ki_pct, strike_pct, period_months)
+            bt_data, stats = run_comprehensive_backtest(df['Date'].to_numpy(), close.astype(np.float32), ki_pct, strike_pct, period_months, ko_pct)
             
             if bt_data is None:
                 st.warning("資料不足")
@@ -263,7 +407,7 @@ if run_btn:
             # ==========================================
             # D. 走勢及關鍵價位圖 (主圖)
             # ==========================================
-            fig_main = plot_integrated_chart(df, ticker, current_price, p_ko, p_ki, p_st)
+            fig_main = plot_integrated_chart(df, ticker, price_lo, price_hi, p_ko, p_ki, p_st)
             st.plotly_chart(fig_main, use_container_width=True)
 
             # ==========================================
@@ -279,10 +423,10 @@ if run_btn:
             **📊 長週期回測報告 (2009/01/01 至今，每 {period_months} 個月一期)：**
             
             1.  **獲利潛力 (正報酬機率)**：
-                若不考慮配息，單純看股價，持有期滿後股價上漲的機率為 **{stats['positive_prob']:.1f}%**。
+                若不考慮配息與提前敲出，單純看股價，持有期滿後股價上漲的機率為 **{stats['positive_prob']:.1f}%**。
                 
             2.  **安全性分析 (不被換到股票的機率)**：
-                在過去 16 年任意時間點進場，有 **{stats['safety_prob']:.1f}%** 的機率可以安全拿回本金 (未跌破 KI 或 跌破後漲回)。
+                在過去 16 年任意時間點進場，有 **{stats['safety_prob']:.1f}%** 的機率可以安全拿回本金 (期間內敲出、未跌破 KI 或 跌破後漲回)。
                 
             3.  **恢復力分析 (回到 Strike 的時間)**：
                 若不幸發生接股票的情況 (機率約 {loss_pct:.1f}%)，根據歷史經驗，**平均等待 {avg_days:.0f} 天** 股價即會漲回 Strike 價格。
@@ -293,7 +437,7 @@ if run_btn:
             # F. 回測圖 (Bar Chart)
             # ==========================================
             st.subheader("📉 歷史滾動回測結果")
-            st.caption("🟩 **綠色**：安全 (拿回本金) ｜ 🟥 **紅色**：接股票 (虧損幅度)")
+            st.caption("🟩 **綠色**：安全 (拿回本金；提前敲出者以面額計) ｜ 🟥 **紅色**：接股票 (虧損幅度)")
             fig_bar = plot_rolling_bar_chart(bt_data, ticker)
             st.plotly_chart(fig_bar, use_container_width=True)
 